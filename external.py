@@ -1,20 +1,31 @@
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dataclasses import dataclass
-from datetime import date
+from pathlib import Path
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import altair as alt
 
 BASELINE_YEAR = 2024
 OPEN_METEO_ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
 OPEN_METEO_FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+ARCHIVE_TTL_S = 7*24*3600
+CACHE_DIR = Path(__file__).parent / ".cache" / "open-meteo"
+_MONTH_NAMES = ["January","February","March","April","May","June","July",
+                "August","September","October","November","December"]
+_MONTH_CAT_DTYPE = pd.CategoricalDtype(_MONTH_NAMES, ordered=True)
 
-# ----------------------------
-# Style Tweaks
-# ----------------------------
-st.set_page_config(page_title="Daylight & Energy", layout="wide")
-
-st.markdown("""
+PAGE_CSS = """
     <style>
     h2, h3, .stSubheader, .stMarkdown {
         color: #555 !important;
@@ -23,16 +34,24 @@ st.markdown("""
         margin-bottom: 0.3rem;
     }
     </style>
-""", unsafe_allow_html=True)
+"""
 
 # Title with cat silhouette
-st.markdown("""
+TITLE_HTML = """
     <div style="display:flex; justify-content:space-between; align-items:center;">
         <h1 style="color:#444; margin: 0;">🌤️ External Lighting Energy Calculator</h1>
         <img src="https://www.svgrepo.com/show/527635/cat.svg" 
              alt="cat" width="45" style="opacity:0.4; margin-left:10px;">
     </div>
-""", unsafe_allow_html=True)
+"""
+
+# ----------------------------
+# Style Tweaks
+# ----------------------------
+st.set_page_config(page_title="Daylight & Energy", layout="wide")
+
+st.markdown(PAGE_CSS, unsafe_allow_html=True)
+st.markdown(TITLE_HTML, unsafe_allow_html=True)
 
 st.caption("Compare two cities | Night-only vs Hourly GHI-based lighting control")
 
@@ -72,35 +91,42 @@ ALL_CITIES = [
     City("Kochi", "India", 9.9312, 76.2673, "Asia/Kolkata"),
 ]
 
-CITY_NAMES = [f"{c.name}, {c.country}" for c in ALL_CITIES]
+CITY_BY_NAME = {f"{c.name}, {c.country}": c for c in ALL_CITIES}
+CITY_NAMES = list(CITY_BY_NAME)
+CITY_LATS = np.array([c.lat for c in ALL_CITIES], dtype=np.float32)
+CITY_LONS = np.array([c.lon for c in ALL_CITIES], dtype=np.float32)
 
 # ----------------------------
 # Sidebar
 # ----------------------------
 with st.sidebar:
-    st.header("📍 Select Cities")
-    city_choice_1 = st.selectbox("City 1", CITY_NAMES, index=0)
-    city_choice_2 = st.selectbox("City 2 (optional)", ["None"] + CITY_NAMES, index=0)
-
-    st.markdown("---")
-    st.header("💡 Lighting Inputs")
-    facade_area = st.number_input("Façade area (m²)", min_value=0.0, value=1000.0, step=10.0)
-    lpd_w_per_m2 = st.number_input("Lighting Power Density (W/m²)", min_value=0.0, value=1.6, step=0.1)
-    installed_kw = st.number_input("Installed lighting load (kW, overrides above if >0)", min_value=0.0, value=0.0, step=0.1)
-    control_factor = st.slider("Control factor (0–1)", 0.0, 1.0, 0.8, 0.05)
-
-    st.markdown("---")
-    st.header("🌞 Hourly GHI Control Thresholds")
-    ghi_on_threshold = st.number_input("Lights ON below (W/m²)", min_value=0.0, value=10.0, step=1.0)
-    ghi_off_threshold = st.number_input("Lights OFF above (W/m²)", min_value=0.0, value=50.0, step=5.0)
-
-    st.markdown("---")
-    st.header("⏱️ Exclusion Hours")
-    use_excl = st.checkbox("Enable exclusion hours?")
-    excl_range = None
-    if use_excl:
+    with st.form("inputs"):
+        st.header("📍 Select Cities")
+        city_choice_1 = st.selectbox("City 1", CITY_NAMES, index=0)
+        city_choice_2 = st.selectbox("City 2 (optional)", ["None"] + CITY_NAMES, index=0)
+
+        st.markdown("---")
+        st.header("💡 Lighting Inputs")
+        facade_area = st.number_input("Façade area (m²)", min_value=0.0, value=1000.0, step=10.0)
+        lpd_w_per_m2 = st.number_input("Lighting Power Density (W/m²)", min_value=0.0, value=1.6, step=0.1)
+        installed_kw = st.number_input("Installed lighting load (kW, overrides above if >0)", min_value=0.0, value=0.0, step=0.1)
+        control_factor = st.slider("Control factor (0–1)", 0.0, 1.0, 0.8, 0.05)
+
+        st.markdown("---")
+        st.header("🌞 Hourly GHI Control Thresholds")
+        ghi_on_threshold = st.number_input("Lights ON below (W/m²)", min_value=0.0, value=10.0, step=1.0)
+        ghi_off_threshold = st.number_input("Lights OFF above (W/m²)", min_value=0.0, value=50.0, step=5.0)
+
+        st.markdown("---")
+        st.header("⏱️ Exclusion Hours")
+        use_excl = st.checkbox("Enable exclusion hours?")
+        # always shown: form widgets only update on submit, so a conditional slider
+        # would stay hidden until a second Run; the range is ignored unless enabled
         excl_range = st.slider("Select exclusion hours (lights OFF during these)", 0, 23, (0, 6))
 
+        st.markdown("---")
+        submitted = st.form_submit_button("Run")
+
 st.markdown(
     f"> ℹ️ **Night-only:** Lights ON during dark hours only.  \n"
     f"**Hourly GHI:** Lights turn ON when GHI < **{ghi_on_threshold:.0f} W/m²** "
@@ -113,89 +139,132 @@ st.markdown(
 # ----------------------------
 # Weather & Data Functions
 # ----------------------------
+@st.cache_resource
+def _session():
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                          max_retries=Retry(total=2, backoff_factor=0.3))
+    s.mount("https://", adapter)
+    return s
+
+@st.cache_data(ttl=600)
 def fetch_current_weather(city):
     params = {"latitude": city.lat, "longitude": city.lon, "current_weather": True, "timezone": city.tz}
-    r = requests.get(OPEN_METEO_FORECAST_URL, params=params, timeout=30)
+    r = _session().get(OPEN_METEO_FORECAST_URL, params=params, timeout=30)
     r.raise_for_status()
     return r.json()["current_weather"]
 
+_WEATHER_ICON = {
+    0: "☀️ Clear",
+    1: "🌤️ Partly Cloudy", 2: "🌤️ Partly Cloudy",
+    3: "☁️ Overcast",
+    45: "🌫️ Fog", 48: "🌫️ Fog",
+    51: "🌧️ Rain", 53: "🌧️ Rain", 55: "🌧️ Rain", 61: "🌧️ Rain", 63: "🌧️ Rain", 65: "🌧️ Rain",
+    71: "❄️ Snow", 73: "❄️ Snow", 75: "❄️ Snow", 77: "❄️ Snow",
+}
+
 def weather_icon(code):
-    if code in [0]: return "☀️ Clear"
-    if code in [1, 2]: return "🌤️ Partly Cloudy"
-    if code in [3]: return "☁️ Overcast"
-    if code in [45, 48]: return "🌫️ Fog"
-    if code in [51, 53, 55, 61, 63, 65]: return "🌧️ Rain"
-    if code in [71, 73, 75, 77]: return "❄️ Snow"
-    return "🌙"
-
-@st.cache_data(ttl=7*24*3600)
-def fetch_city_daily(lat, lon, tz, year):
-    params = {"latitude": lat, "longitude": lon,
-              "start_date": f"{year}-01-01", "end_date": f"{year}-12-31",
-              "daily": "daylight_duration", "timezone": tz}
-    r = requests.get(OPEN_METEO_ARCHIVE_URL, params=params, timeout=30)
-    r.raise_for_status()
-    daily = r.json()["daily"]
-    df = pd.DataFrame({"date": pd.to_datetime(daily["time"]),
-                       "daylight_h": [x / 3600 for x in daily["daylight_duration"]]})
-    df["night_h"] = 24 - df["daylight_h"]
-    return df
-
-@st.cache_data(ttl=7*24*3600)
-def fetch_city_hourly(lat, lon, tz, year):
+    return _WEATHER_ICON.get(code, "🌙")
+
+def _cache_path(lat, lon, tz, year, variable):
+    key = hashlib.blake2b(f"{lat}|{lon}|{tz}|{year}|{variable}".encode()).hexdigest()[:16]
+    return CACHE_DIR / f"{key}.parquet"
+
+def _discard(path):
+    try:
+        path.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+def _read_cached(path):
+    if not (path.exists() and time.time() - os.path.getmtime(path) < ARCHIVE_TTL_S):
+        return None
+    try:
+        return pd.read_parquet(path)
+    except (OSError, pa.ArrowInvalid):
+        # unreadable or stale-schema file: drop it so the caller refetches
+        _discard(path)
+        return None
+
+def _write_cached(df, path):
+    # best effort: a read-only or full disk just means we refetch next time
+    tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(tmp, compression="zstd")
+        os.replace(tmp, path)
+    except OSError:
+        _discard(tmp)
+
+@st.cache_data(ttl=ARCHIVE_TTL_S)
+def fetch_city_archive(lat, lon, tz, year):
+    daily_path = _cache_path(lat, lon, tz, year, "daily")
+    hourly_path = _cache_path(lat, lon, tz, year, "hourly")
+    daily_df, hourly_df = _read_cached(daily_path), _read_cached(hourly_path)
+    if daily_df is not None and hourly_df is not None:
+        return daily_df, hourly_df
+
     params = {"latitude": lat, "longitude": lon,
               "start_date": f"{year}-01-01", "end_date": f"{year}-12-31",
-              "hourly": "shortwave_radiation", "timezone": tz}
-    r = requests.get(OPEN_METEO_ARCHIVE_URL, params=params, timeout=60)
+              "daily": "daylight_duration", "hourly": "shortwave_radiation", "timezone": tz}
+    r = _session().get(OPEN_METEO_ARCHIVE_URL, params=params, timeout=60)
     r.raise_for_status()
-    hourly = r.json()["hourly"]
-    return pd.DataFrame({"datetime": pd.to_datetime(hourly["time"]), "GHI_Wm2": hourly["shortwave_radiation"]})
-
-def monthly_totals_daily(df):
-    df["month"] = df["date"].dt.month
-    agg = df.groupby("month").sum(numeric_only=True).reset_index()
-    agg["Month"] = pd.Categorical(agg["month"].apply(lambda m: date(2000, m, 1).strftime("%B")),
-        categories=["January","February","March","April","May","June","July",
-                    "August","September","October","November","December"], ordered=True)
+    data = orjson.loads(r.content)
+
+    daily = data["daily"]
+    daylight_s = np.asarray(daily["daylight_duration"], dtype=np.float32)
+    dates = pd.date_range(daily["time"][0], periods=daylight_s.size, freq="D")
+    daily_df = pd.DataFrame({"date": dates, "daylight_h": daylight_s / 3600.0})
+    daily_df["night_h"] = 24.0 - daily_df["daylight_h"].to_numpy()
+
+    hourly = data["hourly"]
+    ghi = np.asarray(hourly["shortwave_radiation"], dtype=np.float32)
+    # the archive returns a contiguous local-time series, so only the first stamp needs parsing
+    times = pd.date_range(hourly["time"][0], periods=ghi.size, freq="h")
+    hourly_df = pd.DataFrame({"datetime": times, "GHI_Wm2": ghi})
+    _write_cached(daily_df, daily_path)
+    _write_cached(hourly_df, hourly_path)
+    return daily_df, hourly_df
+
+def monthly_totals_daily(df, months):
+    # dates are sorted, so each month is one contiguous run of rows
+    edges = np.flatnonzero(np.diff(months, prepend=0))
+    sums = np.add.reduceat(df[["daylight_h", "night_h"]].to_numpy(), edges, axis=0)
+    agg = pd.DataFrame({"month": months[edges], "daylight_h": sums[:, 0], "night_h": sums[:, 1]})
+    agg["Month"] = pd.Categorical.from_codes(agg["month"].to_numpy() - 1, dtype=_MONTH_CAT_DTYPE)
     return agg.sort_values("month")
 
-def monthly_lights_on_from_hourly(df, on_thr, off_thr, exclusion_range=None):
-    lights_on = False
-    states = []
-    for dt, ghi in zip(df["datetime"], df["GHI_Wm2"]):
-        hour = dt.hour
-        in_exclusion = False
-        if exclusion_range:
-            if exclusion_range[0] < exclusion_range[1]:
-                in_exclusion = exclusion_range[0] <= hour < exclusion_range[1]
-            else:  # wrap midnight
-                in_exclusion = hour >= exclusion_range[0] or hour < exclusion_range[1]
-
-        if in_exclusion:
-            states.append(False)
-            continue
-
-        if not lights_on and ghi < on_thr:
-            lights_on = True
-        elif lights_on and ghi > off_thr:
-            lights_on = False
-        states.append(lights_on)
-
-    df["lights_on_flag"] = states
-    df["lights_on_h"] = df["lights_on_flag"].astype(int)
-    df["month"] = df["datetime"].dt.month
-    agg = df.groupby("month")["lights_on_h"].sum().reset_index()
-    agg["Month"] = pd.Categorical(
-        agg["month"].apply(lambda m: date(2000, m, 1).strftime("%B")),
-        categories=["January","February","March","April","May","June","July",
-                    "August","September","October","November","December"],
-        ordered=True
-    )
-    return agg.sort_values("month")
+def _hysteresis(ghi, on_thr, off_thr, excluded):
+    # state at each hour is whichever ON/OFF event happened most recently;
+    # excluded hours emit no event and are forced OFF
+    code = np.where(ghi < on_thr, 1, np.where(ghi > off_thr, -1, 0))
+    code[excluded] = 0
+    idx = np.arange(code.size)
+    last_evt_idx = np.maximum.accumulate(np.where(code != 0, idx, -1))
+    state = (last_evt_idx >= 0) & (code[np.clip(last_evt_idx, 0, None)] > 0)
+    return (state & ~excluded).astype(np.uint8)
+
+def monthly_lights_on_from_hourly(df, months, on_thr, off_thr, exclusion_range=None):
+    hours = df["datetime"].dt.hour.to_numpy()
+    excluded = np.zeros(hours.size, dtype=np.bool_)
+    if exclusion_range:
+        if exclusion_range[0] < exclusion_range[1]:
+            excluded = (hours >= exclusion_range[0]) & (hours < exclusion_range[1])
+        else:  # wrap midnight
+            excluded = (hours >= exclusion_range[0]) | (hours < exclusion_range[1])
+
+    ghi = df["GHI_Wm2"].to_numpy(dtype=np.float32)
+    lights_on = _hysteresis(ghi, np.float32(on_thr), np.float32(off_thr), excluded)
+    counts = np.bincount(months[lights_on == 1], minlength=13)[1:]
+    agg = pd.DataFrame({"month": np.arange(1, 13, dtype=np.int8), "lights_on_h": counts})
+    agg["Month"] = pd.Categorical.from_codes(agg["month"].to_numpy() - 1, dtype=_MONTH_CAT_DTYPE)
+    return agg
 
-def process_city(city, on_thr, off_thr, exclusion_range=None):
-    daily = fetch_city_daily(city.lat, city.lon, city.tz, BASELINE_YEAR)
-    hourly = fetch_city_hourly(city.lat, city.lon, city.tz, BASELINE_YEAR)
+@st.cache_data(ttl=ARCHIVE_TTL_S)
+def _agg_hours(lat, lon, tz, on_thr, off_thr, exclusion_range=None):
+    daily, hourly = fetch_city_archive(lat, lon, tz, BASELINE_YEAR)
+    daily_months = pd.DatetimeIndex(daily["date"]).month.to_numpy().astype(np.int8)
+    hourly_months = pd.DatetimeIndex(hourly["datetime"]).month.to_numpy().astype(np.int8)
 
     # adjust night hours if exclusion enabled
     if exclusion_range:
@@ -203,33 +272,55 @@ def process_city(city, on_thr, off_thr, exclusion_range=None):
         daily["night_h"] = (24 - daily["daylight_h"]) - excl_hours
         daily["night_h"] = daily["night_h"].clip(lower=0)
 
-    agg = monthly_totals_daily(daily)
+    agg = monthly_totals_daily(daily, daily_months)
     agg["lights_on_h"] = agg["night_h"]
 
-    monthly_ghi = monthly_lights_on_from_hourly(hourly.copy(), on_thr, off_thr, exclusion_range)
-    agg = agg.merge(monthly_ghi, on=["month", "Month"], suffixes=("", "_ghi"))
+    monthly_ghi = monthly_lights_on_from_hourly(hourly, hourly_months, on_thr, off_thr, exclusion_range)
+    # hourly aggregate has one row per month 1..12, so index it by month directly
+    agg["lights_on_h_ghi"] = monthly_ghi["lights_on_h"].to_numpy()[agg["month"].to_numpy() - 1]
+    return agg
+
+def process_city(city, on_thr, off_thr, exclusion_range=None):
+    # only the energy scaling depends on the lighting inputs; hours are cached
+    agg = _agg_hours(city.lat, city.lon, city.tz, on_thr, off_thr, exclusion_range)
 
     if installed_kw > 0:
         installed_w = installed_kw * 1000
     else:
         installed_w = lpd_w_per_m2 * facade_area
 
-    agg["Energy Night (kWh)"] = (installed_w * agg["lights_on_h"] * control_factor) / 1000
-    agg["Energy GHI (kWh)"] = (installed_w * agg["lights_on_h_ghi"] * control_factor) / 1000
+    hours = agg[["lights_on_h", "lights_on_h_ghi"]].to_numpy(dtype=np.float64)
+    agg[["Energy Night (kWh)", "Energy GHI (kWh)"]] = hours * (installed_w * control_factor / 1000)
     return agg
 
 # ----------------------------
 # Run Calculations
 # ----------------------------
-city_obj_1 = ALL_CITIES[CITY_NAMES.index(city_choice_1)]
-agg1 = process_city(city_obj_1, ghi_on_threshold, ghi_off_threshold, excl_range if use_excl else None)
-weather1 = fetch_current_weather(city_obj_1)
-
-agg2, weather2 = None, None
-if city_choice_2 != "None":
-    city_obj_2 = ALL_CITIES[CITY_NAMES.index(city_choice_2)]
-    agg2 = process_city(city_obj_2, ghi_on_threshold, ghi_off_threshold, excl_range if use_excl else None)
-    weather2 = fetch_current_weather(city_obj_2)
+city_obj_1 = CITY_BY_NAME[city_choice_1]
+city_obj_2 = CITY_BY_NAME.get(city_choice_2)
+exclusion = excl_range if use_excl else None
+
+# only recompute when the form is submitted (or on first load); otherwise reuse the last results
+if submitted or "agg1" not in st.session_state:
+    # network-bound: fetch both cities concurrently, worker threads share this run's context
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=4,
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as pool:
+        agg1_future = pool.submit(process_city, city_obj_1, ghi_on_threshold, ghi_off_threshold, exclusion)
+        weather1_future = pool.submit(fetch_current_weather, city_obj_1)
+        if city_obj_2 is not None:
+            agg2_future = pool.submit(process_city, city_obj_2, ghi_on_threshold, ghi_off_threshold, exclusion)
+            weather2_future = pool.submit(fetch_current_weather, city_obj_2)
+
+        st.session_state["agg1"] = agg1_future.result()
+        st.session_state["weather1"] = weather1_future.result()
+        st.session_state["agg2"], st.session_state["weather2"] = None, None
+        if city_obj_2 is not None:
+            st.session_state["agg2"] = agg2_future.result()
+            st.session_state["weather2"] = weather2_future.result()
+
+agg1, weather1 = st.session_state["agg1"], st.session_state["weather1"]
+agg2, weather2 = st.session_state["agg2"], st.session_state["weather2"]
 
 # ----------------------------
 # Weather Cards
@@ -266,12 +357,19 @@ st.caption(f"🔧 Calculated with ON < **{ghi_on_threshold:.0f} W/m²**, "
 # Line Chart (Fixed Y-axis)
 # ----------------------------
 st.markdown("### 🌗 Daylight vs Dark Hours")
-line_data = agg1[["Month","daylight_h","lights_on_h"]].melt("Month", var_name="Type", value_name="Hours")
-line_data["City"] = city_choice_1
-if agg2 is not None and not agg2.empty:
-    line2 = agg2[["Month","daylight_h","lights_on_h"]].melt("Month", var_name="Type", value_name="Hours")
-    line2["City"] = city_choice_2
-    line_data = pd.concat([line_data, line2])
+@st.cache_data(ttl=ARCHIVE_TTL_S)
+def line_chart_data(city_choices, on_thr, off_thr, exclusion_range=None):
+    frames = []
+    for city_choice in city_choices:
+        city = CITY_BY_NAME[city_choice]
+        agg = _agg_hours(city.lat, city.lon, city.tz, on_thr, off_thr, exclusion_range)
+        tidy = agg[["Month","daylight_h","lights_on_h"]].melt("Month", var_name="Type", value_name="Hours")
+        tidy["City"] = city_choice
+        frames.append(tidy)
+    return pd.concat(frames)
+
+chart_cities = (city_choice_1,) if agg2 is None or agg2.empty else (city_choice_1, city_choice_2)
+line_data = line_chart_data(chart_cities, ghi_on_threshold, ghi_off_threshold, exclusion)
 
 line_chart = (
     alt.Chart(line_data)
@@ -283,7 +381,7 @@ line_chart = (
         strokeDash="Type",
         tooltip=["City","Month","Type","Hours"]
     )
-    .properties(height=450)
+    .properties(height=450, width="container")
 )
 st.altair_chart(line_chart, use_container_width=True)
 